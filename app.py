@@ -1,12 +1,26 @@
 import streamlit as st
 import pandas as pd
-import random
+import numpy as np
 import time
 import json
+import heapq
 import unicodedata
 import difflib
+import copy
 import re
-from io import BytesIO, StringIO
+import sys
+from functools import lru_cache
+from io import BytesIO
+
+try:
+    from rapidfuzz import fuzz  # C++ 實作的 Levenshtein 相似度
+except ImportError:  # 沒裝 rapidfuzz 時退回 difflib
+    fuzz = None
+
+try:
+    import orjson  # 進度檔 JSON 的快速讀寫
+except ImportError:  # 沒裝 orjson 時退回標準庫 json
+    orjson = None
 
 st.set_page_config(page_title="Vocab Quiz+", page_icon="📘", layout="centered")
 
@@ -53,88 +67,171 @@ export_csv_btn = st.sidebar.button("⬇️ 匯出熟練度 CSV", use_container_w
 
 st.sidebar.markdown("---")
 if st.sidebar.button("🧹 清空錯題本", use_container_width=True):
-    st.session_state["wrong_book"] = []
+    st.session_state["wrong_book"] = {}
+    st.session_state["wrong_book_version"] = st.session_state.get("wrong_book_version", 0) + 1
     st.success("錯題本已清空。")
 
 # ================================ Helpers ======================================
+AUTO_ADVANCE_TICK = 0.25  # 自動換題 timer 檢查間隔（秒）
+VOCAB_COLUMNS = ["word", "definition", "example"]
+SR_BASE_DELAY = 6   # 錯題重出間隔的基準（題）
+SR_MAX_DELAY = 20
+
+def tidy_vocab_frame(raw: pd.DataFrame) -> pd.DataFrame:
+    # 前三欄=單字/定義/例句；raw 已用 dtype=str 讀入，不需再 astype(str)
+    df = raw.iloc[:, :3].copy()
+    df.columns = VOCAB_COLUMNS[:df.shape[1]]
+    df = df.reindex(columns=VOCAB_COLUMNS)  # 沒有例句欄時補上空欄
+    df.dropna(subset=["word", "definition"], inplace=True)
+    df = df.assign(word=df["word"].str.strip(), definition=df["definition"].str.strip(),
+                   example=df["example"].fillna("").str.strip())  # 沒有例句 -> ""
+    return df[df["word"].str.len().gt(0)].reset_index(drop=True)
+
 def load_excel(file_bytes: bytes) -> dict:
-    xls = pd.ExcelFile(BytesIO(file_bytes))
+    # 只開一次 workbook；目錄頁 content page 直接跳過不解析；dtype=str 省去型別推斷
+    xls = pd.ExcelFile(BytesIO(file_bytes), engine="openpyxl")
+    wanted = [sheet for sheet in xls.sheet_names if sheet.lower() != "content page"]
+    all_sheets = xls.parse(sheet_name=wanted, dtype=str)
     cats = {}
-    for sheet in xls.sheet_names:
-        raw = pd.read_excel(xls, sheet_name=sheet)
+    for sheet, raw in all_sheets.items():
         if raw.shape[1] < 2:
             continue
-        df = pd.DataFrame({
-            "word": raw.iloc[:, 0],
-            "definition": raw.iloc[:, 1],
-            "example": raw.iloc[:, 2] if raw.shape[1] >= 3 else None
-        }).dropna(subset=["word", "definition"])
-        df["word"] = df["word"].astype(str).str.strip()
-        df["definition"] = df["definition"].astype(str).str.strip()
-        if "example" in df and df["example"] is not None:
-            df["example"] = df["example"].astype(str)
-        df = df[df["word"].str.len() > 0].reset_index(drop=True)
-        if len(df) > 0 and sheet.lower() != "content page":
+        df = tidy_vocab_frame(raw)
+        if len(df) > 0:
             cats[sheet] = df
     return cats
 
 def load_csv(file_bytes: bytes) -> dict:
-    raw = pd.read_csv(BytesIO(file_bytes))
+    try:
+        # pyarrow 引擎多執行緒解析，比預設 C 引擎快（streamlit 本身已依賴 pyarrow）
+        # 不可用 dtype=str：pyarrow 會把空格子轉成字串 "None"；改讀成 string 再轉回 object + NaN，與 C 引擎一致
+        raw = pd.read_csv(BytesIO(file_bytes), dtype="string", engine="pyarrow")
+        raw = raw.astype(object).mask(raw.isna())
+    except (ImportError, ValueError):
+        # 沒裝 pyarrow，或欄數不一致（例如省略例句欄）時 pyarrow 會丟 ParserError/ArrowInvalid（皆為 ValueError）；
+        # C 引擎會把缺的欄位補 NaN
+        raw = pd.read_csv(BytesIO(file_bytes), dtype=str)
     if raw.shape[1] < 2:
         st.error("CSV 至少需要兩欄：第一欄『單字』、第二欄『定義』。")
         st.stop()
-    df = pd.DataFrame({
-        "word": raw.iloc[:, 0],
-        "definition": raw.iloc[:, 1],
-        "example": raw.iloc[:, 2] if raw.shape[1] >= 3 else None
-    }).dropna(subset=["word", "definition"])
-    df["word"] = df["word"].astype(str).str.strip()
-    df["definition"] = df["definition"].astype(str).str.strip()
-    if "example" in df and df["example"] is not None:
-        df["example"] = df["example"].astype(str)
-    return {"All": df.reset_index(drop=True)}
-
-def build_vocab_bank(file) -> dict:
-    if file is None:
-        return {}
-    name = file.name.lower()
+    return {"All": tidy_vocab_frame(raw)}
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def load_vocab(name: str, file_bytes: bytes) -> tuple:
+    # 以檔案內容 bytes 作為快取 key：同一份檔案每次 rerun 只解析一次
+    # cache_resource 不 pickle、所有使用者共用同一份物件 → 回傳的 DataFrame 一律唯讀
+    # 回傳 (categories, cat_names)；cat_names 是跟著快取走的 tuple，每次 rerun 都是同一個物件
     if name.endswith(".xlsx"):
-        return load_excel(file.read())
+        cats = load_excel(file_bytes)
     elif name.endswith(".csv"):
-        return load_csv(file.read())
-    return {}
+        cats = load_csv(file_bytes)
+    else:
+        cats = {}
+    return cats, tuple(cats)
 
-def pick_options(n_total, correct_idx, k=4):
+def build_vocab_bank(file) -> tuple:
+    if file is None:
+        return {}, ()
+    return load_vocab(file.name.lower(), file.getvalue())
+
+def frame_arrays(df: pd.DataFrame) -> tuple:
+    # (DataFrame, words, defs, word_norms, examples)：題庫另存成 numpy object array（SoA），出題/判分直接用整數索引
+    # 例句一律是字串，沒有例句 = ""（錯題本的舊紀錄可能是 None/NaN）
+    if "example" in df:
+        examples = df["example"].fillna("").to_numpy(dtype=object)
+    else:
+        examples = np.full(len(df), "", dtype=object)
+    # intern 單字/定義：選項清單、錯題本、mastery 都指向同一個字串物件
+    words = np.array([sys.intern(w) for w in df["word"]], dtype=object)
+    defs = np.array([sys.intern(d) for d in df["definition"]], dtype=object)
+    # 拼寫題的目標字先 normalize 好，判分時不必每次重算（與 normalize_token 同樣步驟，改用 .str 整欄處理）
+    word_norms = (df["word"].map(strip_accents).str.lower().str.strip()
+                  .str.replace(NORM_RE, "", regex=True).to_numpy(dtype=object))
+    return df, words, defs, word_norms, examples
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def prepared_category(name: str, file_bytes: bytes, cat_name: str) -> tuple:
+    categories, _ = load_vocab(name, file_bytes)
+    return frame_arrays(categories[cat_name])
+
+def pick_options(rng, n_total, correct_idx, k=4):
     if n_total <= 1:
         return [correct_idx]
     k = min(k, n_total)
-    all_idx = list(range(n_total))
-    all_idx.remove(correct_idx)
-    wrong = random.sample(all_idx, k - 1)
-    opts = [correct_idx] + wrong
-    random.shuffle(opts)
-    return opts
+    # Floyd 抽樣：從 n_total-1 個位置抽 k-1 個不重複干擾選項，只跑 k-1 次，與題庫大小無關
+    # （rng.choice(replace=False) 在題庫 < 10000 筆時會先整副 permutation）
+    picks = set()
+    for j in range(n_total - k, n_total - 1):
+        t = int(rng.integers(0, j + 1))
+        picks.add(j if t in picks else t)
+    wrong = np.fromiter(picks, dtype=np.int64, count=k - 1)
+    wrong += (wrong >= correct_idx)  # >= correct_idx 的往後移一格即可跳過正解
+    opts = np.empty(k, dtype=np.int64)
+    opts[0] = correct_idx
+    opts[1:] = wrong
+    rng.shuffle(opts)
+    return opts.tolist()
+
+def pick_options_batch(rng, n_total, correct, k=4):
+    # 向量化版 pick_options：correct 為一批題號，一次抽出每題 k-1 個不重複干擾選項，回傳 (len(correct), k)
+    correct = np.asarray(correct, dtype=np.int64)
+    if n_total <= 1:
+        return correct[:, None]
+    k = min(k, n_total)
+    wrong = rng.integers(0, n_total - 1, size=(len(correct), k - 1))
+    while True:  # 有重複的列整列重抽
+        srt = np.sort(wrong, axis=1)
+        dup = (srt[:, 1:] == srt[:, :-1]).any(axis=1)
+        if not dup.any():
+            break
+        wrong[dup] = rng.integers(0, n_total - 1, size=(int(dup.sum()), k - 1))
+    wrong += (wrong >= correct[:, None])
+    return rng.permuted(np.column_stack([correct, wrong]), axis=1)
+
+COMBINING_TABLE = dict.fromkeys(range(0x0300, 0x0370))  # 組合用變音符號 U+0300–U+036F -> 刪除
+NORM_RE = re.compile(r"[\s\-\u2010\u2011\u2013\u2014\u2019']")  # 空白、各種連字/破折、直/彎引號
 
 def strip_accents(s: str) -> str:
     # 移除重音/變音符號（café -> cafe, naïve -> naive）
-    return ''.join(c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c))
+    if s.isascii():  # 絕大多數英文單字是純 ASCII，NFKD 不會改變任何字元
+        return s
+    return unicodedata.normalize('NFKD', s).translate(COMBINING_TABLE)
 
+@lru_cache(maxsize=4096)
 def normalize_token(s: str) -> str:
     # 忽略大小寫、重音、空白/連字號/撇號等符號
     s = strip_accents(s or "")
     s = s.lower().strip()
-    s = re.sub(r"[\s\-\u2010\u2011\u2013\u2014\u2019']", "", s)  # 空白、各種連字/破折、直/彎引號
+    s = NORM_RE.sub("", s)
     return s
 
-def similarity_pct(a: str, b: str) -> float:
-    a_n, b_n = normalize_token(a), normalize_token(b)
-    return difflib.SequenceMatcher(None, a_n, b_n).ratio() * 100
-
-def spelling_verdict(user: str, target: str, threshold_pct: float) -> str:
-    # 回傳 'exact' | 'near' | 'wrong'
-    if normalize_token(user) == normalize_token(target):
+@lru_cache(maxsize=64)
+def target_matcher(b_n: str) -> difflib.SequenceMatcher:
+    # difflib 備援用：每個目標字只建一次 b2j 索引（set_seq2 最貴的部分），跨 session 共用、建好後不再修改
+    sm = difflib.SequenceMatcher(None)
+    sm.set_seq2(b_n)
+    return sm
+
+@lru_cache(maxsize=256)
+def similarity_norm(a_n: str, b_n: str) -> float:
+    # a_n / b_n 皆為 normalize_token 之後的字串；判分與顯示 near 百分比會用同一組字串各算一次，故快取
+    if fuzz is not None:
+        return fuzz.ratio(a_n, b_n)
+    # 淺複製共用 b2j，set_seq1 只動複本自己的欄位，多個 session 同時判分也安全
+    sm = copy.copy(target_matcher(b_n))
+    sm.set_seq1(a_n)
+    return sm.ratio() * 100
+
+def spelling_verdict(user: str, target_norm: str, threshold_pct: float) -> str:
+    # 回傳 'exact' | 'near' | 'wrong'；target_norm = 預先算好的 normalize_token(目標字)
+    user_norm = normalize_token(user)
+    if user_norm == target_norm:
         return "exact"
-    if similarity_pct(user, target) >= threshold_pct:
+    # 相似度上限 = 2*min(長度)/(長度和)；長度差太多不可能過門檻，不必跑比對
+    lu, lt = len(user_norm), len(target_norm)
+    if 200 * min(lu, lt) < threshold_pct * (lu + lt):
+        return "wrong"
+    if similarity_norm(user_norm, target_norm) >= threshold_pct:
         return "near"
     return "wrong"
 
@@ -142,15 +239,23 @@ def ensure_session():
     if "stats" not in st.session_state:
         st.session_state.stats = {"xp": 0, "correct": 0, "total": 0, "streak": 0}
     if "wrong_book" not in st.session_state:
-        st.session_state.wrong_book = []
+        # wrong_book[(word, definition)] = {"word", "definition", "example"}；dict 保留加入順序
+        st.session_state.wrong_book = {}
+    if "wrong_book_version" not in st.session_state:
+        # 錯題本每次增刪 +1，用來判斷快取的 DataFrame 是否過期
+        st.session_state.wrong_book_version = 0
     if "mastery" not in st.session_state:
         # mastery[word] = {"seen":0,"correct":0,"wrong":0}
         st.session_state.mastery = {}
     if "await_next" not in st.session_state:
         st.session_state.await_next = False
+    if "rng" not in st.session_state:
+        st.session_state.rng = np.random.default_rng()
     if "sr_queue" not in st.session_state:
-        # 間隔重複的待出題列：每題之後 due-1，為 0 時插入下一題
-        st.session_state.sr_queue = []  # list[{"idx": int, "due": int}]
+        # 間隔重複的待出題列：min-heap，sr_clock（已出題數）到達 due_at 時插入下一題
+        st.session_state.sr_queue = []  # heap[(due_at, idx)]
+    if "sr_clock" not in st.session_state:
+        st.session_state.sr_clock = 0
     if "exam_active" not in st.session_state:
         st.session_state.exam_active = False
     if "exam_remaining" not in st.session_state:
@@ -158,6 +263,7 @@ def ensure_session():
     if "exam_correct" not in st.session_state:
         st.session_state.exam_correct = 0
     st.session_state.shuffle_each_question_flag = shuffle_each_question
+    st.session_state.lookahead = items_per_round
 
 def update_mastery(word: str, correct: bool):
     m = st.session_state.mastery.setdefault(word, {"seen": 0, "correct": 0, "wrong": 0})
@@ -168,82 +274,131 @@ def update_mastery(word: str, correct: bool):
         m["wrong"] += 1
 
 def add_to_wrong_book(word: str, definition: str, example: str | None):
-    for rec in st.session_state["wrong_book"]:
-        if rec["word"] == word and rec["definition"] == definition:
-            return
-    st.session_state["wrong_book"].append({"word": word, "definition": definition, "example": example})
+    key = (word, definition)
+    if key not in st.session_state["wrong_book"]:
+        st.session_state["wrong_book"][key] = {"word": word, "definition": definition, "example": example}
+        st.session_state["wrong_book_version"] += 1
 
 def remove_from_wrong_book(word: str, definition: str):
-    st.session_state["wrong_book"] = [
-        rec for rec in st.session_state["wrong_book"]
-        if not (rec["word"] == word and rec["definition"] == definition)
-    ]
+    if st.session_state["wrong_book"].pop((word, definition), None) is not None:
+        st.session_state["wrong_book_version"] += 1
+
+def prepared_wrong_book() -> tuple:
+    # 錯題本沒變動時沿用上次建好的 DataFrame 與 arrays
+    version = st.session_state["wrong_book_version"]
+    cached = st.session_state.get("wrong_book_cache")
+    if cached is None or cached[0] != version:
+        df = pd.DataFrame(list(st.session_state["wrong_book"].values()))
+        cached = (version, frame_arrays(df))
+        st.session_state["wrong_book_cache"] = cached
+    return cached[1]
+
+def sr_delay(word: str) -> int:
+    # half-life 式間隔：答對越多次隔越久、答錯越多次隔越短；第一次答錯 = 3 題後
+    m = st.session_state.mastery.get(word, {"correct": 0, "wrong": 1})
+    # 指數先夾住：答對上千次時 2 ** correct 轉 float 會 OverflowError；6 * 2**5 已超過 SR_MAX_DELAY，結果不變
+    half_life = SR_BASE_DELAY * 2.0 ** min(m["correct"] - m["wrong"], 5)
+    return int(min(SR_MAX_DELAY, max(1, half_life)))
 
 def schedule_spaced_repetition(idx: int, delay: int = 3):
-    # 錯題 after 3 題再出現（簡單版 SR）
-    st.session_state.sr_queue.append({"idx": idx, "due": delay})
+    # 錯題 delay 題後再出現
+    heapq.heappush(st.session_state.sr_queue, (st.session_state.sr_clock + delay, idx))
 
 def sr_tick_and_pick():
-    """每次出題前呼叫：讓 sr_queue 的 due 減 1，若有 due=0 的，優先出這題。"""
-    for item in st.session_state.sr_queue:
-        item["due"] = max(0, item["due"] - 1)
-    due_items = [i for i in st.session_state.sr_queue if i["due"] == 0]
-    if due_items:
-        chosen = due_items[0]["idx"]
-        # 移除第一個 due 的
-        st.session_state.sr_queue = [i for i in st.session_state.sr_queue if not (i["due"] == 0 and i["idx"] == chosen)]
-        return chosen
+    """每次出題前呼叫：sr_clock 加 1，若 heap 頂端已到期，優先出這題。"""
+    st.session_state.sr_clock += 1
+    heap = st.session_state.sr_queue
+    if heap and heap[0][0] <= st.session_state.sr_clock:
+        return heapq.heappop(heap)[1]
     return None
 
-def next_question(state):
-    data = state["data"]
+def reset_deck(state, n: int):
+    # 題序：partial Fisher-Yates，抽到哪才洗到哪；重置只需把 remaining 指回 n，不必整副重洗
+    if len(state.get("pool", ())) != n:
+        state["pool"] = np.arange(n, dtype=np.int64)
+    state["remaining"] = n
+    state["question_queue"] = []
+
+def draw_from_deck(state, r: int) -> np.ndarray:
+    # 從 pool[:remaining] 不重複抽 r 張：每抽一張就換到尾端，remaining 減 1
+    pool, rem = state["pool"], state["remaining"]
+    r = min(r, rem)
+    picks = state["rng"].integers(0, rem - np.arange(r))
+    for t, j in enumerate(picks):
+        last = rem - 1 - t
+        pool[j], pool[last] = pool[last], pool[j]
+    state["remaining"] = rem - r
+    return pool[rem - r:rem][::-1].copy()
+
+def set_round_data(prepared: tuple):
+    (st.session_state.data, st.session_state.words, st.session_state.defs,
+     st.session_state.word_norms, st.session_state.examples) = prepared
+
+def set_quiz_mode(state, mode: str):
+    # 題型在一輪中固定：先決定題幹/選項各取哪個 array，next_question 只剩索引
+    state["mode"] = mode
+    state["is_spelling"] = mode == "Spelling (Definition ➜ Word)"
+    state["prompt_is_definition"] = mode != "Word ➜ Definition (選義)"
+    state["prompts"] = state["defs"] if state["prompt_is_definition"] else state["words"]
+    state["answers"] = state["words"] if state["prompt_is_definition"] else state["defs"]
+    # 已排隊的題目已從 pool 抽出，換題型時保留題號、只依新題型重建題幹/選項
+    queued = [item["current_idx"] for item in state.get("question_queue", [])]
+    queue_questions(state, np.asarray(queued, dtype=np.int64))
+
+def build_question(state, q_idx: int) -> dict:
+    # 單題版本（SR 插隊的題目用）
+    if state["is_spelling"]:
+        opts_idx = np.empty(0, dtype=np.int64)
+    else:
+        opts_idx = np.asarray(pick_options(state["rng"], len(state["data"]), q_idx, k=4))
+        if st.session_state.shuffle_each_question_flag:
+            opts_idx = opts_idx[state["rng"].permutation(len(opts_idx))]
+    return {
+        "current_idx": q_idx,
+        "prompt_text": state["prompts"][q_idx],
+        "options_idx": opts_idx.tolist(),
+        "options_text": state["answers"][opts_idx].tolist(),
+    }
 
+def prepare_round(state, r: int):
+    """從題序一次預先產生接下來 r 題，之後每次換題只需 pop 一題"""
+    if state["remaining"] == 0:
+        reset_deck(state, len(state["data"]))
+    queue_questions(state, draw_from_deck(state, r))
+
+def queue_questions(state, q: np.ndarray):
+    # 依目前題型替題號 q 建好題幹/選項，放進 question_queue
+    if state["is_spelling"]:
+        opts = np.empty((len(q), 0), dtype=np.int64)
+    else:
+        opts = pick_options_batch(state["rng"], len(state["data"]), q, k=4)
+        if st.session_state.shuffle_each_question_flag:
+            opts = state["rng"].permuted(opts, axis=1)
+    # q 本身已是隨機順序，從尾端 pop 即可
+    state["question_queue"] = [
+        {"current_idx": i, "prompt_text": p, "options_idx": o, "options_text": t}
+        for i, p, o, t in zip(q.tolist(), state["prompts"][q].tolist(),
+                              opts.tolist(), state["answers"][opts].tolist())
+    ]
+
+def next_question(state):
     # SR 檢查
     sr_idx = sr_tick_and_pick()
     if sr_idx is not None:
-        q_idx = sr_idx
+        question = build_question(state, sr_idx)
     else:
-        if not state["indices_left"]:
-            idx = list(range(len(data)))
-            random.shuffle(idx)
-            state["indices_left"] = idx[:]
-        q_idx = state["indices_left"].pop()
-
-    state["current_idx"] = q_idx
-
-    if state["mode"] == "Definition ➜ Word (選詞)":
-        state["prompt_text"] = data.loc[q_idx, "definition"]
-        state["prompt_is_definition"] = True
-        state["is_spelling"] = False
-        opts_idx = pick_options(len(data), q_idx, k=4)
-        state["options_idx"] = opts_idx
-        state["options_text"] = [data.loc[i, "word"] for i in opts_idx]
-    elif state["mode"] == "Word ➜ Definition (選義)":
-        state["prompt_text"] = data.loc[q_idx, "word"]
-        state["prompt_is_definition"] = False
-        state["is_spelling"] = False
-        opts_idx = pick_options(len(data), q_idx, k=4)
-        state["options_idx"] = opts_idx
-        state["options_text"] = [data.loc[i, "definition"] for i in opts_idx]
-    else:  # Spelling
-        state["prompt_text"] = data.loc[q_idx, "definition"]
-        state["prompt_is_definition"] = True
-        state["is_spelling"] = True
-        state["options_idx"] = []
-        state["options_text"] = []
-        state["typed_answer"] = ""
-
-    if st.session_state.shuffle_each_question_flag and not state["is_spelling"]:
-        pair = list(zip(state["options_idx"], state["options_text"]))
-        random.shuffle(pair)
-        if pair:
-            state["options_idx"], state["options_text"] = map(list, zip(*pair))
+        if not state["question_queue"]:
+            prepare_round(state, state["lookahead"])
+        question = state["question_queue"].pop()
 
+    state.update(question)
+    if state["is_spelling"]:
+        state["typed_answer"] = ""
     state["selected"] = None
     state["await_next"] = False
 
 # ================================ Load Data ====================================
-categories = build_vocab_bank(uploaded_vocab)
+categories, cat_names = build_vocab_bank(uploaded_vocab)
 if not categories:
     st.title("📘 Vocabulary Quiz+")
     st.info("左側上傳 Excel/CSV 開始。建議：Excel 第一欄=單字、第二欄=定義、第三欄=例句（可選）。")
@@ -252,7 +407,6 @@ if not categories:
 ensure_session()
 
 # 類別選擇（一般模式要選 sheet；錯題本模式忽略）
-cat_names = list(categories.keys())
 if mode_choice == "一般模式":
     selected_cat = st.selectbox("Category / 類別", cat_names, index=0)
 else:
@@ -260,41 +414,43 @@ else:
 
 # 取資料：一般模式=從選定 sheet；錯題本模式=從 wrong_book
 if mode_choice == "一般模式":
-    df_base = categories[selected_cat].copy()
+    prepared = prepared_category(uploaded_vocab.name.lower(), uploaded_vocab.getvalue(), selected_cat)
 else:
-    if len(st.session_state.get("wrong_book", [])) == 0:
+    if len(st.session_state.get("wrong_book", {})) == 0:
         st.warning("你的錯題本目前是空的。請先在『一般模式』做題累積錯題。")
         st.stop()
-    df_base = pd.DataFrame(st.session_state.wrong_book)
+    prepared = prepared_wrong_book()
 
+df_base = prepared[0]
 if len(df_base) < 1:
     st.warning("有效詞條不足，請更換類別或補充資料。")
     st.stop()
 
-# 初始化 / 模式或類別或題型變更時重置
-if ("mode" not in st.session_state) or (st.session_state.mode != quiz_mode) or \
-   ("cat" not in st.session_state) or (st.session_state.cat != selected_cat) or \
-   ("data" not in st.session_state) or \
-   ("practice_mode" not in st.session_state) or (st.session_state.practice_mode != mode_choice):
-    st.session_state.mode = quiz_mode
-    st.session_state.cat = selected_cat
-    st.session_state.practice_mode = mode_choice
-    st.session_state.data = df_base.reset_index(drop=True)
-    indices = list(range(len(st.session_state.data)))
-    random.shuffle(indices)
-    st.session_state.indices_left = indices[:]
+# 初始化 / 題庫（檔案、類別、練習模式）變更時整輪重置；只換題型時沿用題序與統計
+# 以上傳檔本身做鍵：id(categories) 在快取被清掉重建時可能換值或被重用，不可靠
+data_signature = (uploaded_vocab.name, uploaded_vocab.file_id, selected_cat, mode_choice)
+if st.session_state.get("data_signature") != data_signature:
+    st.session_state.data_signature = data_signature
+    st.session_state.advance_at = None
+    st.session_state.sr_queue = []  # 舊題庫的題號在新題庫沒有意義
+    set_round_data(prepared)
+    reset_deck(st.session_state, len(st.session_state.data))
+    set_quiz_mode(st.session_state, quiz_mode)
     st.session_state.stats = {"xp": 0, "correct": 0, "total": 0, "streak": 0}
     next_question(st.session_state)
+elif st.session_state.mode != quiz_mode:
+    st.session_state.advance_at = None
+    set_quiz_mode(st.session_state, quiz_mode)
+    next_question(st.session_state)
 
 # 開始分級測驗（固定題數，結束給成績）
 if start_exam:
     st.session_state.exam_active = True
     st.session_state.exam_remaining = min(exam_len, len(st.session_state.data))
     st.session_state.exam_correct = 0
+    st.session_state.advance_at = None  # 舊的自動換題計時不可跳過測驗第一題
     # 重建不重複題組
-    indices = list(range(len(st.session_state.data)))
-    random.shuffle(indices)
-    st.session_state.indices_left = indices[:]
+    reset_deck(st.session_state, len(st.session_state.data))
     next_question(st.session_state)
 
 # ================================== Main UI ====================================
@@ -313,6 +469,9 @@ with c4:
     st.progress(done / items_per_round)
 
 # 分級測驗狀態提示
+exam_result = st.session_state.pop("exam_result", None)
+if exam_result:
+    st.success(exam_result)
 if st.session_state.exam_active:
     st.info(f"🎯 分級測驗進行中 | 剩餘題數：{st.session_state.exam_remaining} | 目前得分：{st.session_state.exam_correct}")
 
@@ -326,32 +485,30 @@ else:
 st.write(st.session_state["prompt_text"])
 
 # 例句
-if show_examples and "example" in st.session_state.data.columns:
-    try:
-        ex = st.session_state.data.loc[st.session_state["current_idx"], "example"]
-        if pd.notna(ex) and str(ex).strip():
-            with st.expander("Example sentence"):
-                st.write(str(ex))
-    except Exception:
-        pass
-
-# 顯示題目互動區
+ex = st.session_state.examples[st.session_state["current_idx"]]
+if show_examples and ex:
+    with st.expander("Example sentence"):
+        st.write(ex)
+
+# 顯示題目互動區：包在 form 裡，選答案/打字不會觸發 rerun，按 Submit 才送出
+await_next = st.session_state.get("await_next", False)
 typed = None
 choice = None
-if st.session_state.get("is_spelling", False):
-    typed = st.text_input("Type the correct word (拼寫)", value=st.session_state.get("typed_answer", ""))
-else:
-    choice = st.radio(
-        label="Select one:",
-        options=range(len(st.session_state["options_text"])),
-        format_func=lambda i: st.session_state["options_text"][i],
-        index=None,
-        key="selected_radio",
-    )
+with st.form("quiz", border=False):
+    if st.session_state.get("is_spelling", False):
+        typed = st.text_input("Type the correct word (拼寫)", value=st.session_state.get("typed_answer", ""))
+    else:
+        choice = st.radio(
+            label="Select one:",
+            options=range(len(st.session_state["options_text"])),
+            format_func=lambda i: st.session_state["options_text"][i],
+            index=None,
+            key="selected_radio",
+        )
+    submitted = st.form_submit_button("Submit", type="primary", use_container_width=True, disabled=await_next)
 
 # ================================= Buttons =====================================
 b1, b2, b3 = st.columns([1,1,1])
-await_next = st.session_state.get("await_next", False)
 
 def finish_or_next():
     """處理分級測驗結束與換題邏輯"""
@@ -360,27 +517,36 @@ def finish_or_next():
         if st.session_state.exam_remaining <= 0:
             score = st.session_state.exam_correct
             st.session_state.exam_active = False
-            st.success(f"🎉 測驗結束！得分 {score} / {exam_len}（{score/exam_len*100:.0f}%）")
+            st.session_state.exam_result = f"🎉 測驗結束！得分 {score} / {exam_len}（{score/exam_len*100:.0f}%）"
             st.session_state.await_next = True  # 等使用者重設/繼續
-            return
+            st.rerun()
     next_question(st.session_state)
     st.rerun()
 
+def schedule_auto_advance():
+    """不在 server 端 sleep：記下換題時間，交給 auto_advance_timer 定時檢查"""
+    st.session_state.advance_at = time.time() + auto_delay
+    st.session_state.await_next = True  # 等待期間可直接按 Next
+
+def auto_advance_timer():
+    advance_at = st.session_state.get("advance_at")
+    if advance_at is None or time.time() < advance_at:
+        return
+    st.session_state.advance_at = None
+    finish_or_next()
+
 with b1:
-    if await_next:
-        if st.button("Next", type="primary", use_container_width=True):
-            st.session_state.await_next = False
-            next_question(st.session_state)
-            st.rerun()
-    else:
-        if st.button("Submit", type="primary", use_container_width=True,
-                     disabled=(typed is None and choice is None) or (st.session_state.get("is_spelling", False) and (typed or "").strip()=="" )):
+    next_slot = st.empty()  # Next 等 Submit/Skip 處理完才畫，剛出結果就能直接按
+    if not await_next:
+        answered = (typed or "").strip() != "" if st.session_state.get("is_spelling", False) else choice is not None
+        if submitted and not answered:
+            st.warning("請先作答再送出。")
+        elif submitted:
             st.session_state.stats["total"] += 1
-            data = st.session_state.data
             correct_idx = st.session_state["current_idx"]
-            word_corr = data.loc[correct_idx, "word"]
-            def_corr  = data.loc[correct_idx, "definition"]
-            ex_corr   = data.loc[correct_idx, "example"] if "example" in data.columns else None
+            word_corr = st.session_state.words[correct_idx]
+            def_corr  = st.session_state.defs[correct_idx]
+            ex_corr   = st.session_state.examples[correct_idx] or None
 
             # 判斷正誤（含拼寫模糊比對）
             feedback_mode = "wrong"
@@ -389,8 +555,9 @@ with b1:
 
             if st.session_state.get("is_spelling", False):
                 user = (typed or "").strip()
+                target_norm = st.session_state.word_norms[correct_idx]
                 if enable_fuzzy:
-                    verdict = spelling_verdict(user, str(word_corr), near_threshold)
+                    verdict = spelling_verdict(user, target_norm, near_threshold)
                     if verdict == "exact":
                         is_correct = True
                         feedback_mode = "exact"
@@ -401,7 +568,7 @@ with b1:
                         is_correct = False
                         feedback_mode = "wrong"
                 else:
-                    is_correct = (normalize_token(user) == normalize_token(str(word_corr)))
+                    is_correct = (normalize_token(user) == target_norm)
                     feedback_mode = "exact" if is_correct else "wrong"
             else:
                 picked_idx  = st.session_state["options_idx"][choice]
@@ -412,7 +579,7 @@ with b1:
             if feedback_mode == "exact":
                 st.success("✅ Correct! +1 XP")
             elif feedback_mode == "near":
-                sim = similarity_pct(user, str(word_corr))
+                sim = similarity_norm(normalize_token(user), target_norm)
                 if count_near_as_correct:
                     st.info(f"🟡 Almost! ({sim:.0f}%) — 已視為正確")
                 else:
@@ -433,50 +600,48 @@ with b1:
                 st.session_state.stats["streak"] = 0
                 if mode_choice == "一般模式":
                     add_to_wrong_book(word_corr, def_corr, ex_corr)
-                # SR：錯題 3 題後再出現（若 near 但算錯，也安排）
-                schedule_spaced_repetition(correct_idx, delay=3)
+                # SR：依熟練度決定幾題後再出現（若 near 但算錯，也安排）
+                schedule_spaced_repetition(correct_idx, delay=sr_delay(word_corr))
 
             # 分級測驗得分
             if st.session_state.exam_active and is_correct:
                 st.session_state.exam_correct += 1
 
             # 自動/手動換題
-            if auto_delay > 0 and not st.session_state.exam_active:
-                time.sleep(auto_delay)
-                finish_or_next()
-            elif auto_delay > 0 and st.session_state.exam_active:
-                time.sleep(auto_delay)
-                finish_or_next()
+            if auto_delay > 0:
+                schedule_auto_advance()
             else:
                 st.session_state.await_next = True
 
 with b2:
-    if await_next:
-        st.button("Skip", use_container_width=True, disabled=True)
-    else:
-        if st.button("Skip", use_container_width=True):
-            st.info("⏭️ Skipped.")
-            st.session_state.stats["streak"] = 0
-            if auto_delay > 0 and not st.session_state.exam_active:
-                time.sleep(auto_delay)
-                next_question(st.session_state)
-                st.rerun()
-            else:
-                st.session_state.await_next = True
+    if st.button("Skip", use_container_width=True, disabled=st.session_state.await_next):
+        st.info("⏭️ Skipped.")
+        st.session_state.stats["streak"] = 0
+        if auto_delay > 0 and not st.session_state.exam_active:
+            schedule_auto_advance()
+        else:
+            st.session_state.await_next = True
+
+if next_slot.button("Next", type="primary", use_container_width=True, disabled=not st.session_state.await_next):
+    st.session_state.await_next = False
+    st.session_state.advance_at = None
+    finish_or_next()  # 與自動換題同一路徑，分級測驗才會扣題數
 
 with b3:
     if st.button("Reset round", use_container_width=True):
-        st.session_state.data = (categories[selected_cat].copy().reset_index(drop=True)
-                                 if mode_choice == "一般模式"
-                                 else pd.DataFrame(st.session_state.wrong_book).reset_index(drop=True))
-        idx = list(range(len(st.session_state.data)))
-        random.shuffle(idx)
-        st.session_state.indices_left = idx[:]
+        set_round_data(prepared)
+        reset_deck(st.session_state, len(st.session_state.data))
+        set_quiz_mode(st.session_state, quiz_mode)
         st.session_state.stats = {"xp": 0, "correct": 0, "total": 0, "streak": 0}
         st.session_state.sr_queue = []
+        st.session_state.advance_at = None
         next_question(st.session_state)
         st.rerun()
 
+# 自動換題計時：fragment 定時重跑，時間到才觸發整頁 rerun
+if st.session_state.get("advance_at") is not None:
+    st.fragment(run_every=AUTO_ADVANCE_TICK)(auto_advance_timer)()
+
 st.caption("Tip: 一般模式可累積錯題；錯題本模式只練錯過的題（答對即移除）。Spelling 模式支援模糊比對。分級測驗：固定題數、給總分。")
 
 # ========================= Export / Import Progress ============================
@@ -484,33 +649,37 @@ st.caption("Tip: 一般模式可累積錯題；錯題本模式只練錯過的題
 if export_json_btn:
     payload = {
         "mastery": st.session_state.mastery,
-        "wrong_book": st.session_state.wrong_book
+        "wrong_book": list(st.session_state.wrong_book.values())
     }
-    buf = json.dumps(payload, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        buf = orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        buf = json.dumps(payload, ensure_ascii=False, indent=2)
     st.download_button("下載 progress.json", data=buf, file_name="progress.json", mime="application/json")
 
 # 匯出熟練度 CSV
 if export_csv_btn:
-    rows = []
-    for w, m in st.session_state.mastery.items():
-        seen = m["seen"]
-        correct = m["correct"]
-        wrong = m["wrong"]
-        acc = (correct / seen * 100) if seen > 0 else 0
-        rows.append({"word": w, "seen": seen, "correct": correct, "wrong": wrong, "accuracy_%": f"{acc:.0f}"})
-    df_out = pd.DataFrame(rows).sort_values(by=["accuracy_%","seen"], ascending=[False, False])
-    csv_buf = StringIO()
-    df_out.to_csv(csv_buf, index=False)
+    df_out = pd.DataFrame.from_dict(st.session_state.mastery, orient="index",
+                                    columns=["seen", "correct", "wrong"]).astype("int64")
+    df_out.index.name = "word"
+    df_out["accuracy_%"] = (df_out["correct"] / df_out["seen"].clip(lower=1) * 100).round().astype(int)
+    df_out = df_out.sort_values(by=["accuracy_%", "seen"], ascending=[False, False])
+    csv_buf = BytesIO()
+    df_out.to_csv(csv_buf, encoding="utf-8")
     st.download_button("下載 mastery.csv", data=csv_buf.getvalue(), file_name="mastery.csv", mime="text/csv")
 
-# 載入 JSON 進度
-if uploaded_progress is not None:
+# 載入 JSON 進度：同一個上傳檔只匯入一次，避免每次 rerun 覆寫進度並讓錯題本快取失效
+if uploaded_progress is not None and st.session_state.get("progress_file_id") != uploaded_progress.file_id:
+    st.session_state.progress_file_id = uploaded_progress.file_id
     try:
-        loaded = json.loads(uploaded_progress.getvalue())
+        loaded = (orjson.loads if orjson is not None else json.loads)(uploaded_progress.getvalue())
         if "mastery" in loaded and isinstance(loaded["mastery"], dict):
             st.session_state.mastery = loaded["mastery"]
         if "wrong_book" in loaded and isinstance(loaded["wrong_book"], list):
-            st.session_state.wrong_book = loaded["wrong_book"]
+            st.session_state.wrong_book = {
+                (rec["word"], rec["definition"]): rec for rec in loaded["wrong_book"]
+            }
+            st.session_state.wrong_book_version += 1
         st.success("已載入進度（mastery / wrong_book）")
     except Exception as e:
         st.error(f"讀取進度檔失敗：{e}")